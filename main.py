@@ -1,13 +1,19 @@
 """FastAPI application for automated code generation and GitHub deployment."""
+import asyncio
 import os
+import posixpath
+import re
+import string
+from contextlib import asynccontextmanager
 from typing import List, Optional
-from fastapi import FastAPI, HTTPException, Header
+from fastapi import Depends, FastAPI, HTTPException, Header, Request
 from pydantic import BaseModel
 import httpx
+import orjson
 from dotenv import load_dotenv
 
 from services.llm_service import LLMService
-from services.github_service import GitHubService
+from services.github_service import AsyncGitHubService
 from services.utils import (
     decode_data_uri,
     get_task_info,
@@ -18,8 +24,20 @@ from services.utils import (
 # Load environment variables
 load_dotenv()
 
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Expose the shared HTTP client to request handlers."""
+    # The HTTP clients are created at import and live as long as the process,
+    # so they are not closed here; a later startup in the same process
+    # (e.g. another TestClient session) would otherwise get closed clients
+    app.state.http = http_client
+    yield
+
+
 # Initialize FastAPI
-app = FastAPI(title="TDS Auto-Deploy API")
+app = FastAPI(title="TDS Auto-Deploy API", lifespan=lifespan)
 
 # Configuration
 API_SECRET = os.getenv("API_SECRET")
@@ -27,10 +45,43 @@ GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
 GITHUB_USERNAME = os.getenv("GITHUB_USERNAME", "sanat-garg")
 AIPIPE_API_KEY = os.getenv("AIPIPE_API_KEY")
 AIPIPE_BASE_URL = os.getenv("AIPIPE_BASE_URL", "https://aipipe.org/openrouter/v1")
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "false").lower() in ("1", "true", "yes")
+
+# One pooled client for GitHub calls and evaluator notifications. GitHub
+# credentials go on each request, never on the client, so they stay with GitHub
+http_client = httpx.AsyncClient(
+    timeout=30.0,
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=50)
+)
 
 # Initialize services
-llm_service = LLMService(api_key=AIPIPE_API_KEY, base_url=AIPIPE_BASE_URL)
-github_service = GitHubService(token=GITHUB_TOKEN, username=GITHUB_USERNAME)
+llm_service = LLMService(api_key=AIPIPE_API_KEY, base_url=AIPIPE_BASE_URL, semantic_cache=SEMANTIC_CACHE)
+github_service = AsyncGitHubService(token=GITHUB_TOKEN, username=GITHUB_USERNAME, client=http_client)
+
+# Extracts the JSON object from a previously generated attachments.js
+ATTACHMENTS_JS_RE = re.compile(r'window\.attachments\s*=\s*({.+})\s*;', re.DOTALL)
+
+# Fallback README used when the LLM doesn't generate one
+FALLBACK_README = string.Template("""# ${repo_name}
+
+## Overview
+Auto-generated project based on: ${brief}
+
+## Features
+- Please refer to the application for full functionality details
+
+## Usage
+1. Open `index.html` in a web browser
+2. Follow any on-screen instructions
+
+## Technical Details
+- Built with vanilla HTML, CSS, and JavaScript
+- No external dependencies required
+
+## Evaluation Criteria
+${checks}
+""")
 
 
 class Attachment(BaseModel):
@@ -61,6 +112,19 @@ class TaskResponse(BaseModel):
     pages_url: str
 
 
+def attachment_path(name: str) -> str:
+    """Return the repository path for an attachment name, always inside attachments/."""
+    # Rooting the name first makes normpath drop any "..", duplicate or
+    # leading slashes, so the result is a clean relative path
+    relative = posixpath.normpath("/" + name).lstrip("/")
+    return f"attachments/{relative or 'attachment'}"
+
+
+def get_http_client(request: Request) -> httpx.AsyncClient:
+    """Return the shared HTTP client exposed by lifespan."""
+    return request.app.state.http
+
+
 @app.get("/")
 async def root():
     """Root endpoint."""
@@ -68,12 +132,16 @@ async def root():
 
 
 @app.post("/app", response_model=TaskResponse)
-async def process_task(request: TaskRequest):
+async def process_task(
+    request: TaskRequest,
+    http: httpx.AsyncClient = Depends(get_http_client)
+):
     """
     Process a task: generate code, deploy to GitHub, enable Pages, and notify.
     
     Args:
         request: Task request with all details
+        http: Shared HTTP client used to notify the evaluation URL
     
     Returns:
         Task response with repository information
@@ -88,12 +156,8 @@ async def process_task(request: TaskRequest):
         
         # Step 2: Repository Management
         if request.round == 1:
-            # Round 1: Create fresh repository
-            if github_service.repo_exists(repo_name):
-                github_service.delete_repo(repo_name)
-            
-            repo = github_service.create_repo(repo_name)
-            existing_code = None
+            # Round 1: Fresh repository is created in Step 5, alongside the LLM call
+            repo = None
             existing_files = {}
         else:
             # Round > 1: Get existing repository
@@ -104,29 +168,27 @@ async def process_task(request: TaskRequest):
                     detail=f"No existing repository found for task {request.task}"
                 )
             
-            repo = github_service.get_repo(repo_name)
+            repo = await github_service.get_repo(repo_name)
             # Get existing code for modification
-            existing_files = github_service.get_existing_files(repo)
-            existing_code = "\n\n".join(
-                f"=== {filename} ===\n{content}" 
-                for filename, content in existing_files.items()
-            )
+            existing_files = await github_service.get_existing_files(repo)
         
         # Step 3: Handle Attachments
-        # Build attachments.js file with all attachments (accumulate across rounds)
+        # Base64 attachments are committed as real files under attachments/, and
+        # attachments.js maps each name to its path or URL (accumulates across rounds)
         attachments_dict = {}
+        attachment_files = {}
         
         # Always try to load existing attachments if they exist
         if "attachments.js" in existing_files:
             # Parse existing attachments.js to get previous attachments
-            import re
-            import json
             js_content = existing_files["attachments.js"]
             # Extract the JSON part from window.attachments = {...};
-            match = re.search(r'window\.attachments\s*=\s*({.+})\s*;', js_content, re.DOTALL)
+            match = ATTACHMENTS_JS_RE.search(js_content)
             if match:
                 try:
-                    attachments_dict = json.loads(match.group(1))
+                    # Keep values as they are: older rounds embedded data URIs, and
+                    # the code generated then decodes them itself
+                    attachments_dict.update(orjson.loads(match.group(1)))
                     print(f"Loaded {len(attachments_dict)} existing attachments")
                 except Exception as e:
                     print(f"Failed to parse existing attachments: {e}")
@@ -134,8 +196,17 @@ async def process_task(request: TaskRequest):
         
         # Add new attachments to the dictionary (will append, or overwrite if same name)
         for attachment in request.attachments:
-            # Store the full data URI (not decoded)
-            attachments_dict[attachment.name] = attachment.url
+            previous = attachments_dict.get(attachment.name, "")
+            if ";base64," in attachment.url and not previous.startswith("data:"):
+                # Commit the decoded bytes, not the base64 data URI; the name
+                # stays the window.attachments key, the path is sanitized
+                path = attachment_path(attachment.name)
+                attachment_files[path] = decode_data_uri(attachment.url)
+                attachments_dict[attachment.name] = path
+            else:
+                # Plain URLs and non-base64 data URIs are used as given, as are
+                # replacements for data URIs that earlier code still decodes
+                attachments_dict[attachment.name] = attachment.url
             print(f"Added attachment: {attachment.name}")
         
         # Get ALL attachment names (old + new) for LLM
@@ -145,42 +216,53 @@ async def process_task(request: TaskRequest):
         # Step 4: Generate attachments.js (API-generated, not LLM)
         attachments_js_content = None
         if attachments_dict:
-            import json
             attachments_js_content = f"""// Auto-generated attachments file
-// Access attachments via: window.attachments["filename.ext"]
-window.attachments = {json.dumps(attachments_dict, indent=2)};
+// window.attachments["filename.ext"] is the file's path in this repository, or its URL
+window.attachments = {orjson.dumps(attachments_dict, option=orjson.OPT_INDENT_2).decode()};
 """
         
         # Step 5: LLM Code Generation
-        try:
-            generated_files = llm_service.generate_code(
-                brief=request.brief,
-                checks=request.checks,
-                attachment_names=attachment_names,
-                existing_code=existing_code
-            )
-        except ValueError as e:
-            # If JSON parsing fails, provide detailed error
-            raise HTTPException(
-                status_code=500,
-                detail=f"LLM generated invalid response: {str(e)}"
-            )
-        except Exception as e:
-            # Generic LLM error
-            raise HTTPException(
-                status_code=500,
-                detail=f"LLM generation failed: {str(e)}"
-            )
+        async def generate():
+            try:
+                return await llm_service.generate_code(
+                    brief=request.brief,
+                    checks=request.checks,
+                    attachment_names=attachment_names,
+                    existing_code=existing_files or None
+                )
+            except ValueError as e:
+                # If JSON parsing fails, provide detailed error
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"LLM generated invalid response: {str(e)}"
+                )
+            except Exception as e:
+                # Generic LLM error
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"LLM generation failed: {str(e)}"
+                )
         
-        # Step 6: Prepare all files for commit
-        all_files = {}
+        async def create_fresh_repo():
+            if await github_service.repo_exists(repo_name):
+                await github_service.delete_repo(repo_name)
+            return await github_service.create_repo(repo_name)
+        
+        if request.round == 1:
+            # Round 1: Recreate the repository while the LLM is generating
+            repo, generated_files = await asyncio.gather(create_fresh_repo(), generate())
+        else:
+            generated_files = await generate()
         
-        # For round 2+, start with existing files then update with new ones
+        # Step 6: Prepare all files for commit
+        # For round 2+, start with existing files (excluding attachments.js,
+        # which we regenerate) then update with new ones
+        all_files = {
+            filename: content
+            for filename, content in existing_files.items()
+            if filename != "attachments.js"
+        }
         if request.round > 1:
-            # Copy all existing files first (excluding attachments.js)
-            for filename, content in existing_files.items():
-                if filename != "attachments.js":  # We'll regenerate this
-                    all_files[filename] = content
             print(f"Starting with {len(all_files)} existing files for round {request.round}")
         
         # Update/add generated files (this will overwrite existing files with same name)
@@ -196,23 +278,27 @@ window.attachments = {json.dumps(attachments_dict, indent=2)};
         
         # Validate that HTML is complete (not truncated)
         html_content = all_files["index.html"]
-        if not html_content.strip().endswith("</html>") and not html_content.strip().endswith("</HTML>"):
+        if not html_content.rstrip().endswith(("</html>", "</HTML>")):
             print(f"WARNING: HTML appears truncated. Last 200 chars: {html_content[-200:]}")
             # Try to close the HTML properly
-            if "<html" in html_content.lower() and "</html>" not in html_content.lower():
+            html_lower = html_content.lower()
+            if "<html" in html_lower and "</html>" not in html_lower:
                 html_content += "\n</body>\n</html>"
                 all_files["index.html"] = html_content
                 print("Auto-closed HTML tags")
         
-        # Add attachments.js if we have attachments
+        # Add attachments.js and the attachment files if we have attachments
         if attachments_js_content:
             all_files["attachments.js"] = attachments_js_content
+        all_files.update(attachment_files)
         
         # Handle evaluation criteria requirements
         print(f"Evaluation criteria to satisfy: {request.checks}")
+        checks_lower = [check.lower() for check in request.checks]
+        mit_license_required = any("mit license" in check for check in checks_lower)
+        public_repo_required = any("public" in check for check in checks_lower)
         
         # Check for MIT license requirement
-        mit_license_required = any("mit license" in check.lower() for check in request.checks)
         if mit_license_required or "LICENSE" not in all_files:
             all_files["LICENSE"] = get_mit_license()
             print("Added MIT License file")
@@ -220,58 +306,57 @@ window.attachments = {json.dumps(attachments_dict, indent=2)};
         # Ensure README.md exists (LLM should generate detailed one, but fallback if needed)
         if "README.md" not in all_files:
             # Create a basic README as fallback
-            basic_readme = f"""# {repo_name}
-
-## Overview
-Auto-generated project based on: {request.brief}
-
-## Features
-- Please refer to the application for full functionality details
-
-## Usage
-1. Open `index.html` in a web browser
-2. Follow any on-screen instructions
-
-## Technical Details
-- Built with vanilla HTML, CSS, and JavaScript
-- No external dependencies required
-
-## Evaluation Criteria
-{chr(10).join(f"- {check}" for check in request.checks)}
-"""
-            all_files["README.md"] = basic_readme
+            all_files["README.md"] = FALLBACK_README.substitute(
+                repo_name=repo_name,
+                brief=request.brief,
+                checks="\n".join(map("- {}".format, request.checks))
+            )
             print("Created fallback README.md")
         else:
             print("Using LLM-generated README.md")
         
         # Step 7: Commit to GitHub
         commit_message = f"Round {request.round}: {request.brief}"
-        commit_sha = github_service.commit_files(
+        commit_sha = await github_service.commit_files(
             repo=repo,
             files=all_files,
             message=commit_message
         )
         
-        # Step 8: Enable GitHub Pages and ensure repo is public
-        github_service.enable_github_pages(repo)
+        # Get URLs
+        repo_url = github_service.get_repo_url(repo_name)
+        pages_url = github_service.get_pages_url(repo_name)
         
-        # Ensure repository is public (common evaluation requirement)
-        public_repo_required = any("public" in check.lower() for check in request.checks)
-        if public_repo_required:
-            try:
-                if repo.private:
-                    print("Making repository public as required by evaluation criteria")
-                    repo.edit(private=False)
-            except Exception as e:
-                print(f"Warning: Could not ensure repository is public: {e}")
+        # Step 8: Enable GitHub Pages and ensure repo is public
+        async def ensure_public():
+            # Ensure repository is public (common evaluation requirement)
+            if public_repo_required:
+                try:
+                    if repo["private"]:
+                        print("Making repository public as required by evaluation criteria")
+                        await github_service.make_public(repo)
+                except Exception as e:
+                    print(f"Warning: Could not ensure repository is public: {e}")
         
+        # Pages and visibility are independent, so configure them together
+        await asyncio.gather(
+            github_service.enable_github_pages(repo),
+            ensure_public()
+        )
         print("Repository configuration completed")
         
-        # Get URLs
-        repo_url = github_service.get_repo_url(repo_name)
-        pages_url = github_service.get_pages_url(repo_name)
+        # Step 9: Update State
+        # Recorded before notifying, so a round 2 sent straight after the
+        # notification finds this round's repository
+        update_task_info(request.task, {
+            "repo_name": repo_name,
+            "repo_url": repo_url,
+            "commit_sha": commit_sha,
+            "pages_url": pages_url,
+            "last_round": request.round
+        })
         
-        # Step 9: Notify Evaluation URL
+        # Step 10: Notify Evaluation URL
         notification_payload = {
             "email": request.email,
             "task": request.task,
@@ -281,18 +366,7 @@ Auto-generated project based on: {request.brief}
             "commit_sha": commit_sha,
             "pages_url": pages_url
         }
-        
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            await client.post(request.evaluation_url, json=notification_payload)
-        
-        # Step 10: Update State
-        update_task_info(request.task, {
-            "repo_name": repo_name,
-            "repo_url": repo_url,
-            "commit_sha": commit_sha,
-            "pages_url": pages_url,
-            "last_round": request.round
-        })
+        await http.post(request.evaluation_url, json=notification_payload)
         
         # Step 11: Return Response
         return TaskResponse(
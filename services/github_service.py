@@ -1,47 +1,157 @@
 """GitHub service for repository management and GitHub Pages deployment."""
-import os
-import time
-from typing import Dict, List, Optional
-from github import Github, GithubException
-from github.Repository import Repository
+import asyncio
 import base64
+import hashlib
+import time
+from typing import Dict, Optional, Tuple, Union
+import httpx
+
+
+GITHUB_API_URL = "https://api.github.com"
+
+# How long a fetched repository handle is reused before asking GitHub again
+REPO_CACHE_TTL = 60  # seconds
 
+# Polling schedules: first delay, doubled after every attempt, up to a total budget
+DELETE_POLL_DELAY = 0.2  # seconds
+DELETE_POLL_BUDGET = 2  # seconds
+PAGES_POLL_DELAY = 0.5  # seconds
+PAGES_POLL_BUDGET = 5  # seconds
 
-class GitHubService:
-    """Service for interacting with GitHub API."""
+# Total size of the GET responses kept for conditional (If-None-Match) requests
+ETAG_CACHE_BYTES = 16 * 1024 * 1024
+# Total size of decoded blob text kept by SHA (blobs never change)
+BLOB_CACHE_BYTES = 32 * 1024 * 1024
+
+# Files that are never useful as text, so get_existing_files doesn't download them
+BINARY_EXTENSIONS = (
+    '.png', '.jpg', '.jpeg', '.gif', '.webp', '.ico',
+    '.woff', '.woff2', '.ttf', '.otf',
+    '.pdf', '.zip', '.gz', '.mp3', '.mp4', '.wav'
+)
+
+# Larger files are skipped by get_existing_files; the LLM can't use them anyway
+MAX_EXISTING_FILE_SIZE = 1024 * 1024  # bytes
+
+
+class AsyncGitHubService:
+    """Service for interacting with the GitHub REST API over async httpx."""
     
-    def __init__(self, token: str, username: str):
+    def __init__(self, token: str, username: str, client: Optional[httpx.AsyncClient] = None):
         """
         Initialize GitHub service.
         
         Args:
             token: GitHub Personal Access Token
             username: GitHub username
+            client: Shared HTTP client to send requests through (one is created if omitted)
         """
-        self.github = Github(token)
         self.username = username
-        self.user = self.github.get_user()
+        # Credentials go on each request rather than on the client, so a
+        # shared client never leaks the token to other hosts
+        self.headers = {
+            "Authorization": f"Bearer {token}",
+            "Accept": "application/vnd.github+json",
+            "X-GitHub-Api-Version": "2022-11-28"
+        }
+        self._owns_client = client is None
+        self.client = client or httpx.AsyncClient(timeout=30.0, http2=True)
+        self._repo_cache: Dict[str, Tuple[float, Dict]] = {}
+        # url -> (etag, data, response size), oldest first
+        self._etag_cache: Dict[str, Tuple[str, Dict, int]] = {}
+        self._etag_cache_bytes = 0
+        # blob sha -> decoded text (None for binary), oldest first
+        self._blob_cache: Dict[str, Optional[str]] = {}
+        self._blob_cache_bytes = 0
+    
+    async def aclose(self):
+        """Close the underlying HTTP client, unless it was passed in."""
+        if self._owns_client:
+            await self.client.aclose()
+    
+    async def _request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """Send a request to the GitHub API and raise on error responses."""
+        response = await self.client.request(method, url, headers=self.headers, **kwargs)
+        response.raise_for_status()
+        return response
+    
+    async def _get_json(self, url: str, params: Optional[Dict] = None) -> Dict:
+        """
+        GET a JSON resource, revalidating any earlier copy with its ETag.
+        
+        GitHub answers 304 Not Modified for unchanged resources, and those
+        responses don't count against the rate limit.
+        """
+        key = str(self.client.build_request("GET", url, params=params).url)
+        cached = self._etag_cache.get(key)
+        headers = {**self.headers, "If-None-Match": cached[0]} if cached else self.headers
+        
+        response = await self.client.get(url, params=params, headers=headers)
+        if response.status_code == 304 and cached:
+            return cached[1]
+        response.raise_for_status()
+        
+        data = response.json()
+        etag = response.headers.get("ETag")
+        size = len(response.content)
+        if etag and size <= ETAG_CACHE_BYTES:
+            if key in self._etag_cache:
+                self._etag_cache_bytes -= self._etag_cache.pop(key)[2]
+            while self._etag_cache_bytes + size > ETAG_CACHE_BYTES:
+                # Evict the oldest entry
+                self._etag_cache_bytes -= self._etag_cache.pop(next(iter(self._etag_cache)))[2]
+            self._etag_cache[key] = (etag, data, size)
+            self._etag_cache_bytes += size
+        return data
+    
+    def _cache_repo(self, repo_name: str, repo: Dict) -> Dict:
+        """Remember a repository for REPO_CACHE_TTL seconds."""
+        self._repo_cache[repo_name] = (time.monotonic(), repo)
+        return repo
     
-    def repo_exists(self, repo_name: str) -> bool:
+    async def _fetch_repo(self, repo_name: str) -> Dict:
+        """Return a cached repository, fetching it from GitHub if stale."""
+        entry = self._repo_cache.get(repo_name)
+        if entry and time.monotonic() - entry[0] < REPO_CACHE_TTL:
+            return entry[1]
+        response = await self._request("GET", f"{GITHUB_API_URL}/repos/{self.username}/{repo_name}")
+        return self._cache_repo(repo_name, response.json())
+    
+    async def repo_exists(self, repo_name: str) -> bool:
         """Check if repository exists."""
         try:
-            self.user.get_repo(repo_name)
+            await self._fetch_repo(repo_name)
             return True
-        except GithubException:
-            return False
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 404:
+                return False
+            raise
     
-    def delete_repo(self, repo_name: str):
+    async def delete_repo(self, repo_name: str):
         """Delete a repository."""
         try:
-            repo = self.user.get_repo(repo_name)
-            repo.delete()
-            # Wait a bit for deletion to complete
-            time.sleep(2)
-        except GithubException as e:
-            if e.status != 404:
+            await self._request("DELETE", f"{GITHUB_API_URL}/repos/{self.username}/{repo_name}")
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 404:
                 raise
+            return
+        finally:
+            self._repo_cache.pop(repo_name, None)
+        
+        # Wait until GitHub stops serving the repository, so it can be recreated
+        delay, waited = DELETE_POLL_DELAY, 0.0
+        while waited < DELETE_POLL_BUDGET:
+            try:
+                await self._request("GET", f"{GITHUB_API_URL}/repos/{self.username}/{repo_name}")
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code == 404:
+                    return
+                raise
+            await asyncio.sleep(min(delay, DELETE_POLL_BUDGET - waited))
+            waited += delay
+            delay *= 2
     
-    def create_repo(self, repo_name: str, description: str = "Auto-generated project") -> Repository:
+    async def create_repo(self, repo_name: str, description: str = "Auto-generated project") -> Dict:
         """
         Create a new repository.
         
@@ -50,25 +160,57 @@ class GitHubService:
             description: Repository description
         
         Returns:
-            Created repository object
+            Created repository as returned by the GitHub API
         """
-        repo = self.user.create_repo(
-            name=repo_name,
-            description=description,
-            private=False,  # Always create public repos for evaluation
-            auto_init=False
-        )
+        response = await self._request("POST", f"{GITHUB_API_URL}/user/repos", json={
+            "name": repo_name,
+            "description": description,
+            "private": False,  # Always create public repos for evaluation
+            "auto_init": False
+        })
         print(f"Created public repository: {repo_name}")
-        return repo
+        return self._cache_repo(repo_name, response.json())
     
-    def get_repo(self, repo_name: str) -> Repository:
+    async def get_repo(self, repo_name: str) -> Dict:
         """Get existing repository."""
-        return self.user.get_repo(repo_name)
+        return await self._fetch_repo(repo_name)
+    
+    async def make_public(self, repo: Dict):
+        """Switch a repository's visibility to public."""
+        response = await self._request("PATCH", repo["url"], json={"private": False})
+        self._cache_repo(repo["name"], response.json())
+    
+    async def _get_head_sha(self, repo: Dict, branch: str) -> Optional[str]:
+        """Return the commit SHA at the tip of a branch, or None for an empty repo."""
+        try:
+            ref = await self._get_json(f"{repo['url']}/git/ref/heads/{branch}")
+        except httpx.HTTPStatusError as e:
+            # 409 means the repository has no commits yet
+            if e.response.status_code in (404, 409):
+                return None
+            raise
+        return ref["object"]["sha"]
+    
+    @staticmethod
+    def _git_blob_sha(content: Union[str, bytes]) -> str:
+        """Compute the SHA git assigns to a blob with this content."""
+        data = content if isinstance(content, bytes) else content.encode('utf-8')
+        return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
     
-    def commit_files(
-        self, 
-        repo: Repository, 
-        files: Dict[str, str], 
+    async def _create_blob(self, repo: Dict, content: Union[str, bytes]) -> str:
+        """Upload a file's content as a blob and return its SHA."""
+        if isinstance(content, bytes):
+            # Binary files are sent base64-encoded and stored byte for byte
+            blob = {"content": base64.b64encode(content).decode('ascii'), "encoding": "base64"}
+        else:
+            blob = {"content": content, "encoding": "utf-8"}
+        response = await self._request("POST", f"{repo['url']}/git/blobs", json=blob)
+        return response.json()["sha"]
+    
+    async def commit_files(
+        self,
+        repo: Dict,
+        files: Dict[str, Union[str, bytes]],
         message: str = "Auto-generated commit",
         branch: str = "main"
     ) -> str:
@@ -76,146 +218,125 @@ class GitHubService:
         Commit multiple files to repository.
         
         Args:
-            repo: Repository object
-            files: Dictionary mapping filename to content
+            repo: Repository returned by get_repo or create_repo
+            files: Dictionary mapping filename to text or binary content
             message: Commit message
             branch: Branch name
         
         Returns:
             Commit SHA
         """
-        # Check if repo is empty (no commits yet)
-        try:
-            repo.get_branch(branch)
-            repo_empty = False
-        except GithubException:
-            repo_empty = True
+        files = dict(files)
         
-        if repo_empty:
-            # For empty repo, use create_file for the first file to initialize
-            # then update the rest in a single commit
-            from github import InputGitTreeElement
-            
-            # Create first file to initialize the repo
-            first_filepath = list(files.keys())[0]
-            first_content = files[first_filepath]
-            
-            if isinstance(first_content, bytes):
-                first_content = first_content.decode('utf-8', errors='ignore')
-            
-            result = repo.create_file(
-                first_filepath,
-                message,
-                first_content,
-                branch=branch
+        head_sha = await self._get_head_sha(repo, branch)
+        
+        if head_sha is None:
+            # The Git Data API rejects empty repositories, so create the first
+            # file through the Contents API to initialize the branch
+            first_filepath = next(iter(files))
+            first_content = files.pop(first_filepath)
+            if isinstance(first_content, str):
+                first_content = first_content.encode('utf-8')
+            response = await self._request(
+                "PUT",
+                f"{repo['url']}/contents/{first_filepath}",
+                json={
+                    "message": message,
+                    "content": base64.b64encode(first_content).decode('ascii'),
+                    "branch": branch
+                }
             )
+            head_sha = response.json()["commit"]["sha"]
             
             # If there's only one file, return early
-            if len(files) == 1:
-                return result['commit'].sha
-            
-            # Now add remaining files to the repo
-            ref = repo.get_git_ref(f"heads/{branch}")
-            latest_commit = repo.get_git_commit(ref.object.sha)
-            base_tree = latest_commit.tree
-            
-            elements = []
-            for filepath, content in list(files.items())[1:]:
-                if isinstance(content, bytes):
-                    content = content.decode('utf-8', errors='ignore')
-                
-                element = InputGitTreeElement(
-                    path=filepath,
-                    mode='100644',
-                    type='blob',
-                    content=content
-                )
-                elements.append(element)
-            
-            new_tree = repo.create_git_tree(elements, base_tree)
-            new_commit = repo.create_git_commit(message, new_tree, [latest_commit])
-            ref.edit(new_commit.sha)
-            
-            return new_commit.sha
-        else:
-            # Update existing files or add new ones
-            from github import InputGitTreeElement
-            
-            ref = repo.get_git_ref(f"heads/{branch}")
-            latest_commit = repo.get_git_commit(ref.object.sha)
-            base_tree = latest_commit.tree
-            
-            elements = []
-            for filepath, content in files.items():
-                if isinstance(content, bytes):
-                    content = content.decode('utf-8', errors='ignore')
-                
-                element = InputGitTreeElement(
-                    path=filepath,
-                    mode='100644',
-                    type='blob',
-                    content=content
-                )
-                elements.append(element)
-            
-            new_tree = repo.create_git_tree(elements, base_tree)
-            new_commit = repo.create_git_commit(message, new_tree, [latest_commit])
-            
-            ref.edit(new_commit.sha)
-            
-            return new_commit.sha
+            if not files:
+                return head_sha
+        
+        base_tree = await self._get_json(f"{repo['url']}/git/trees/{head_sha}", params={"recursive": 1})
+        base_shas = {entry["path"]: entry["sha"] for entry in base_tree["tree"]}
+        
+        # Files whose content hashes to the blob already on the branch are
+        # carried over by base_tree, so only changed files are uploaded
+        changed = {
+            filepath: content
+            for filepath, content in files.items()
+            if base_shas.get(filepath) != self._git_blob_sha(content)
+        }
+        print(f"Uploading {len(changed)} changed of {len(files)} files")
+        
+        # Blobs are independent of each other, so upload them all concurrently
+        blob_shas = await asyncio.gather(
+            *(self._create_blob(repo, content) for content in changed.values())
+        )
+        
+        tree = [
+            {"path": filepath, "mode": "100644", "type": "blob", "sha": blob_sha}
+            for filepath, blob_sha in zip(changed, blob_shas)
+        ]
+        new_tree = (await self._request("POST", f"{repo['url']}/git/trees", json={
+            "base_tree": base_tree["sha"],
+            "tree": tree
+        })).json()
+        
+        new_commit = (await self._request("POST", f"{repo['url']}/git/commits", json={
+            "message": message,
+            "tree": new_tree["sha"],
+            "parents": [head_sha]
+        })).json()
+        
+        await self._request("PATCH", f"{repo['url']}/git/refs/heads/{branch}", json={
+            "sha": new_commit["sha"]
+        })
+        
+        return new_commit["sha"]
     
-    def enable_github_pages(self, repo: Repository, branch: str = "main"):
+    async def enable_github_pages(self, repo: Dict, branch: str = "main"):
         """
         Enable GitHub Pages for repository.
         
         Args:
-            repo: Repository object
+            repo: Repository returned by get_repo or create_repo
             branch: Branch to deploy from
         """
-        try:
-            # Try to get existing Pages configuration
-            try:
-                pages = repo.get_pages_build()
-            except:
-                pass
-            
-            # Enable Pages using the API
-            # Note: PyGithub doesn't have direct Pages support, so we use the underlying requester
-            headers = {"Accept": "application/vnd.github.v3+json"}
-            data = {
-                "source": {
-                    "branch": branch,
-                    "path": "/"
-                }
+        data = {
+            "source": {
+                "branch": branch,
+                "path": "/"
             }
+        }
+        
+        try:
+            # Try to create Pages
+            await self._request("POST", f"{repo['url']}/pages", json=data)
             
-            # Try to create/update Pages
-            repo._requester.requestJsonAndCheck(
-                "POST",
-                f"{repo.url}/pages",
-                headers=headers,
-                input=data
-            )
-            
-            # Wait for Pages to be ready
-            time.sleep(5)
-            
-        except GithubException as e:
+        except httpx.HTTPStatusError as e:
             # If Pages already exists, that's fine
-            if e.status == 409:
+            if e.response.status_code == 409:
                 pass
             else:
                 # Try PUT method for updating
                 try:
-                    repo._requester.requestJsonAndCheck(
-                        "PUT",
-                        f"{repo.url}/pages",
-                        headers=headers,
-                        input=data
-                    )
-                except:
+                    await self._request("PUT", f"{repo['url']}/pages", json=data)
+                except httpx.HTTPError:
                     pass
+            return
+        
+        # Wait for Pages to be ready
+        await self._wait_for_pages(repo)
+    
+    async def _wait_for_pages(self, repo: Dict):
+        """Poll the Pages site until its first build is no longer pending."""
+        delay, waited = PAGES_POLL_DELAY, 0.0
+        while waited < PAGES_POLL_BUDGET:
+            try:
+                response = await self._request("GET", f"{repo['url']}/pages")
+                if response.json().get("status") not in (None, "queued", "building"):
+                    return
+            except httpx.HTTPError:
+                return
+            await asyncio.sleep(min(delay, PAGES_POLL_BUDGET - waited))
+            waited += delay
+            delay *= 2
     
     def get_pages_url(self, repo_name: str) -> str:
         """
@@ -233,12 +354,38 @@ class GitHubService:
         """Get repository URL."""
         return f"https://github.com/{self.username}/{repo_name}"
     
-    def get_existing_files(self, repo: Repository, branch: str = "main") -> Dict[str, str]:
+    async def _get_blob_text(self, repo: Dict, blob_sha: str) -> Optional[str]:
+        """Fetch a single blob as text, or None if it cannot be decoded as UTF-8."""
+        # A blob's content is fixed by its SHA, so a cached copy never needs revalidating
+        if blob_sha in self._blob_cache:
+            return self._blob_cache[blob_sha]
+        
+        blob = (await self._request("GET", f"{repo['url']}/git/blobs/{blob_sha}")).json()
+        text = None
+        try:
+            # Only get text files
+            if blob.get("encoding") == "base64":
+                text = base64.b64decode(blob["content"]).decode('utf-8')
+        except (ValueError, UnicodeDecodeError):
+            # Skip binary files or files that can't be decoded
+            pass
+        
+        size = len(text) if text else 0
+        if size <= BLOB_CACHE_BYTES and blob_sha not in self._blob_cache:
+            while self._blob_cache_bytes + size > BLOB_CACHE_BYTES:
+                # Evict the oldest entry
+                evicted = self._blob_cache.pop(next(iter(self._blob_cache)))
+                self._blob_cache_bytes -= len(evicted) if evicted else 0
+            self._blob_cache[blob_sha] = text
+            self._blob_cache_bytes += size
+        return text
+    
+    async def get_existing_files(self, repo: Dict, branch: str = "main") -> Dict[str, str]:
         """
         Get all files from repository.
         
         Args:
-            repo: Repository object
+            repo: Repository returned by get_repo or create_repo
             branch: Branch name
         
         Returns:
@@ -246,22 +393,23 @@ class GitHubService:
         """
         files = {}
         try:
-            contents = repo.get_contents("", ref=branch)
-            while contents:
-                file_content = contents.pop(0)
-                if file_content.type == "dir":
-                    contents.extend(repo.get_contents(file_content.path, ref=branch))
-                else:
-                    try:
-                        # Only get text files
-                        if file_content.encoding == "base64":
-                            content = base64.b64decode(file_content.content).decode('utf-8')
-                            files[file_content.path] = content
-                    except:
-                        # Skip binary files or files that can't be decoded
-                        pass
-        except GithubException:
+            # One call returns the whole tree, however deeply nested
+            tree = await self._get_json(f"{repo['url']}/git/trees/{branch}", params={"recursive": 1})
+            blobs = [
+                entry for entry in tree["tree"]
+                if entry["type"] == "blob"
+                and not entry["path"].lower().endswith(BINARY_EXTENSIONS)
+                and entry.get("size", 0) <= MAX_EXISTING_FILE_SIZE
+            ]
+            
+            # Fetch every text file concurrently
+            contents = await asyncio.gather(
+                *(self._get_blob_text(repo, entry["sha"]) for entry in blobs)
+            )
+            for entry, content in zip(blobs, contents):
+                if content is not None:
+                    files[entry["path"]] = content
+        except httpx.HTTPStatusError:
             pass
         
         return files
-
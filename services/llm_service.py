@@ -1,92 +1,33 @@
 """LLM service for code generation using AIPipe (OpenRouter-compatible API)."""
 import os
+import asyncio
+import posixpath
 import json
-from typing import List, Dict
+import hashlib
+import random
+import re
+from typing import List, Dict, Optional, Tuple
 import httpx
+import orjson
 
+from services.semantic_cache import SEMANTIC_CACHE_AVAILABLE, SemanticCache
+from services.utils import get_task_info, llm_cache_get, llm_cache_put, update_task_info
 
-class LLMService:
-    """Service for interacting with AIPipe LLM."""
-    
-    def __init__(self, api_key: str, base_url: str = "https://aipipe.org/openrouter/v1"):
-        """
-        Initialize LLM service.
-        
-        Args:
-            api_key: AIPipe API key
-            base_url: Base URL for AIPipe API
-        """
-        self.api_key = api_key
-        self.base_url = base_url
-        self.headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-    
-    def generate_code(
-        self, 
-        brief: str, 
-        checks: List[str], 
-        attachment_names: List[str],
-        existing_code: str = None
-    ) -> Dict[str, str]:
-        """
-        Generate code using LLM.
-        
-        Args:
-            brief: Project brief/description
-            checks: List of evaluation criteria
-            attachment_names: List of attachment filenames
-            existing_code: Existing code to modify (for round > 1)
-        
-        Returns:
-            Dictionary mapping filename to file content
-        """
-        # Build prompt
-        if existing_code:
-            prompt = self._build_modification_prompt(brief, checks, attachment_names, existing_code)
-        else:
-            prompt = self._build_initial_prompt(brief, checks, attachment_names)
-        
-        # Call LLM API
-        response = self._call_api(prompt)
-        
-        # Parse response to extract files
-        files = self._parse_response(response)
-        
-        return files
-    
-    def _build_initial_prompt(self, brief: str, checks: List[str], attachment_names: List[str]) -> str:
-        """Build prompt for initial code generation."""
-        checks_text = "\n".join(f"- {check}" for check in checks)
-        attachments_text = "\n".join(f"- {name}" for name in attachment_names) if attachment_names else "None"
-        
-        attachments_note = ""
-        if attachment_names:
-            attachments_note = f"""
-**Available Attachments:**
-{attachments_text}
 
-**CRITICAL - How to access and use attachments:**
-- All attachments are in `attachments.js` (already created, just import it)
-- Import: `<script src="attachments.js"></script>`
-- Access: `window.attachments["filename.ext"]` returns a data URI string
-- **DATA FORMAT**: Each value is a base64-encoded data URI like "data:image/png;base64,iVBORw..." or "data:text/csv;base64,bmFtZS..."
-- **IMPORTANT**: NEVER embed data URIs directly in HTML attributes! Use JavaScript instead:
-  - ❌ WRONG: `<img src="data:image/png;base64,iVBORw...">`
-  - ✅ CORRECT: `<img id="myImg"><script>document.getElementById('myImg').src = window.attachments['image.png'];</script>`
-- **YOU MUST DECODE text data**: For CSV/JSON, use `atob(window.attachments['data.csv'].split(',')[1])`
-- For images, use JavaScript to set src from window.attachments
-- The brief will tell you exactly what to do with each attachment
-- Follow the brief's instructions precisely
-"""
-        
-        prompt = f"""Create a simple web application using only vanilla HTML, CSS, and JavaScript.
+MODEL = "openai/gpt-4o-mini"
+MAX_TOKENS = 4000
 
-**Brief:** {brief}
+# Transient API failures are retried with exponential backoff plus jitter
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 4
+RETRY_BASE_DELAY = 1.0  # seconds
+RETRY_MAX_DELAY = 30.0  # seconds
+SYSTEM_PROMPT = "You are a code generator that ONLY outputs valid JSON. Never include explanations or markdown. Follow instructions precisely. Always complete your JSON response fully."
 
-**CRITICAL EVALUATION CRITERIA (MUST BE SATISFIED):**
-{checks_text}
+# Prompts put every fixed instruction before the per-task details, so the
+# provider's prompt-prefix cache can skip recomputing the shared part
+INITIAL_PROMPT_HEADER = """Create a simple web application using only vanilla HTML, CSS, and JavaScript.
+The brief and evaluation criteria for this application are given at the end.
 
 **README.md Requirements:**
 - Create a detailed, professional README.md that explains:
@@ -96,10 +37,9 @@ class LLMService:
   - Any special instructions or requirements
   - Make it comprehensive and well-structured
 
-{attachments_note}
 **Technical Requirements:**
 - Use ONLY vanilla HTML, CSS, JavaScript (no frameworks or libraries)
-- Create code that satisfies ALL evaluation criteria above
+- Create code that satisfies ALL evaluation criteria below
 - Main entry point must be index.html
 - Ensure all functionality works as specified in the brief
 - Pay special attention to any URL parameters, timing requirements, or specific behaviors mentioned in evaluation criteria
@@ -108,57 +48,40 @@ class LLMService:
 Return ONLY a valid JSON object. No explanations, no markdown, no extra text.
 
 CRITICAL JSON REQUIREMENTS:
-- Start with {{ and end with }}
+- Start with { and end with }
 - Use double quotes for keys and string values
 - Properly escape special characters: \" for quotes, \\n for newlines, \\\\ for backslashes
 - NO trailing commas before closing braces
 - NO comments in JSON
 
 Example structure:
-{{
+{
   "index.html": "<!DOCTYPE html>\\n<html>...</html>",
   "README.md": "# Title\\n\\nDescription",
-  "style.css": "body {{ margin: 0; }}",
+  "style.css": "body { margin: 0; }",
   "script.js": "console.log('hello');"
-}}
-
-Only include files you're creating/modifying. Return ONLY the JSON, nothing else."""
+}
 
-        return prompt
-    
-    def _build_modification_prompt(
-        self, 
-        brief: str, 
-        checks: List[str], 
-        attachment_names: List[str],
-        existing_code: str
-    ) -> str:
-        """Build prompt for code modification."""
-        checks_text = "\n".join(f"- {check}" for check in checks)
-        
-        attachments_note = ""
-        if attachment_names:
-            attachments_text = "\n".join(f"- {name}" for name in attachment_names)
-            attachments_note = f"""
-**Available Attachments:**
-{attachments_text}
+Only include files you're creating/modifying.
+"""
 
-**CRITICAL:** 
-- Attachments are in `attachments.js` (auto-generated, do NOT modify or regenerate it)
-- Access: `window.attachments["filename.ext"]` returns a base64-encoded data URI
+INITIAL_ATTACHMENT_RULES = """
+**CRITICAL - How to access and use attachments:**
+- All attachments are committed as files in the `attachments/` folder (already created, do not generate them)
+- `attachments.js` maps each name to its path (already created, just import it)
 - Import: `<script src="attachments.js"></script>`
-- **NEVER embed data URIs directly in HTML!** Use JavaScript to set them:
-  - ✅ CORRECT: `<img id="img1"><script>document.getElementById('img1').src = window.attachments['image.png'];</script>`
-- **MUST DECODE text data**: For CSV/JSON, use: `atob(window.attachments['file.csv'].split(',')[1])`
-- Follow the brief's instructions for processing these attachments
+- Access: `window.attachments["filename.ext"]` returns a relative path like "attachments/filename.ext" (or a URL); use it as is
+- **IMPORTANT**: NEVER invent data URIs or inline attachment contents! Use the path instead:
+  - ❌ WRONG: `<img src="data:image/png;base64,iVBORw...">`
+  - ✅ CORRECT: `<img id="myImg"><script>document.getElementById('myImg').src = window.attachments['image.png'];</script>`
+- **Text data**: For CSV/JSON, load it with `fetch(window.attachments['data.csv']).then(r => r.text())`
+- For images, use JavaScript to set src from window.attachments
+- The brief will tell you exactly what to do with each attachment
+- Follow the brief's instructions precisely
 """
-        
-        prompt = f"""You are modifying an EXISTING web application. Build upon the current code.
-
-**New Requirements to ADD/MODIFY:** {brief}
 
-**CRITICAL EVALUATION CRITERIA (MUST BE SATISFIED):**
-{checks_text}
+MODIFICATION_PROMPT_HEADER = """You are modifying an EXISTING web application. Build upon the current code.
+The new requirements, evaluation criteria and current code are given at the end.
 
 **README.md Requirements:**
 - Update the README.md to reflect any new features or changes
@@ -166,15 +89,12 @@ Only include files you're creating/modifying. Return ONLY the JSON, nothing else
 - Document any new functionality added in this round
 - Keep it comprehensive and well-structured
 
-**Current Code (DO NOT DISCARD, BUILD UPON THIS):**
-{existing_code}
-{attachments_note}
 **CRITICAL Instructions:**
 - **BUILD UPON** the existing code, don't start from scratch
 - **ADD or MODIFY** features as requested in the new requirements
 - **PRESERVE** existing functionality unless explicitly asked to remove it
 - **EXTEND** the code, don't replace it entirely
-- **SATISFY ALL EVALUATION CRITERIA** listed above
+- **SATISFY ALL EVALUATION CRITERIA** listed below
 - Pay special attention to URL parameters, timing requirements, or specific behaviors
 - Keep using vanilla HTML, CSS, JavaScript only
 - Update README.md with new features and changes
@@ -184,30 +104,420 @@ Only include files you're creating/modifying. Return ONLY the JSON, nothing else
 Return ONLY a valid JSON object. No explanations, no markdown, no extra text.
 
 CRITICAL JSON REQUIREMENTS:
-- Start with {{ and end with }}
+- Start with { and end with }
 - Use double quotes for keys and string values
 - Properly escape: \" for quotes, \\n for newlines, \\\\ for backslashes
 - NO trailing commas before closing braces
 - NO comments in JSON
 
 Example:
-{{
+{
   "index.html": "<!DOCTYPE html>\\n<html>...</html>",
   "README.md": "# Updated\\n\\nChanges made"
-}}
+}
+
+Only include files you're modifying.
+"""
+
+MODIFICATION_ATTACHMENT_RULES = """
+**CRITICAL:** 
+- Attachments are committed as files in the `attachments/` folder, and `attachments.js` maps each name to its path (both auto-generated, do NOT modify or regenerate them)
+- Access: `window.attachments["filename.ext"]` returns a relative path like "attachments/filename.ext", or a URL (older attachments may be data URIs); use it as is
+- Import: `<script src="attachments.js"></script>`
+- **NEVER invent data URIs or inline attachment contents!** Use JavaScript to set the path:
+  - ✅ CORRECT: `<img id="img1"><script>document.getElementById('img1').src = window.attachments['image.png'];</script>`
+- **Text data**: For CSV/JSON, load it with `fetch(window.attachments['file.csv']).then(r => r.text())`
+- Follow the brief's instructions for processing these attachments
+"""
+
+PROMPT_FOOTER = "Return ONLY the JSON, nothing else."
+
+# Fixed pieces between the dynamic parts of a prompt, joined in _build_*_prompt
+INITIAL_ATTACHMENTS_BLOCK = INITIAL_ATTACHMENT_RULES + "\n**Available Attachments:**\n"
+MODIFICATION_ATTACHMENTS_BLOCK = MODIFICATION_ATTACHMENT_RULES + "\n**Available Attachments:**\n"
+INITIAL_BRIEF_LABEL = "\n**Brief:** "
+MODIFICATION_BRIEF_LABEL = "\n**New Requirements to ADD/MODIFY:** "
+CHECKS_LABEL = "\n\n**CRITICAL EVALUATION CRITERIA (MUST BE SATISFIED):**\n"
+EXISTING_FILES_LABEL = "\n\n**Existing Files (kept as they are unless you return them):**\n"
+EXISTING_CODE_LABEL = "\n\n**Current Code (DO NOT DISCARD, BUILD UPON THIS):**\n"
+
+# Existing files whose full content is always sent with a modification prompt;
+# others are only listed unless the brief or checks name them, or an included
+# file loads them
+ALWAYS_INCLUDED_FILES = ("index.html", "README.md")
+# Generated by the API rather than the LLM, so never sent in full
+CONTEXT_EXCLUDED_FILES = ("LICENSE", "attachments.js")
+# Local files loaded through src="..." or href="..."
+REFERENCE_RE = re.compile(r'''(?:src|href)\s*=\s*["']([^"'#?]+)''', re.IGNORECASE)
+FOOTER_BLOCK = "\n\n" + PROMPT_FOOTER
 
-Only include files you're modifying. Return ONLY the JSON, nothing else."""
+# Repairs used by _parse_response when the LLM output isn't valid JSON
+TRAILING_COMMA_RE = re.compile(r',(\s*[}\]])')
+# Matches "filename.ext": "content" pairs
+FILE_ENTRY_RE = re.compile(r'"([^"]+\.(html|css|js|md))"\s*:\s*"((?:[^"\\]|\\.)*)"', re.DOTALL)
 
-        return prompt
+
+class LLMService:
+    """Service for interacting with AIPipe LLM."""
+    
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str = "https://aipipe.org/openrouter/v1",
+        semantic_cache: bool = False
+    ):
+        """
+        Initialize LLM service.
+        
+        Args:
+            api_key: AIPipe API key
+            base_url: Base URL for AIPipe API
+            semantic_cache: Reuse results for reworded first-round briefs (needs
+                sentence-transformers)
+        """
+        self.api_key = api_key
+        self.base_url = base_url
+        self.headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+            # Brotli first; decoding it needs the httpx[brotli] extra
+            "Accept-Encoding": "br, gzip"
+        }
+        # One pooled client for every call, so keep-alive connections skip
+        # the TCP and TLS handshakes. httpx sets Content-Type per request,
+        # which the multipart batch upload relies on.
+        self._client = httpx.AsyncClient(
+            base_url=base_url,
+            headers={
+                "Authorization": self.headers["Authorization"],
+                "Accept-Encoding": self.headers["Accept-Encoding"]
+            },
+            timeout=httpx.Timeout(180.0),
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+            http2=True
+        )
+        # Opt-in only: briefs built from one template can look near-identical
+        # while needing different code
+        self.semantic_cache = None
+        if semantic_cache:
+            if SEMANTIC_CACHE_AVAILABLE:
+                self.semantic_cache = SemanticCache()
+            else:
+                print("Semantic cache requested but sentence-transformers is not installed; disabled")
+    
+    async def aclose(self):
+        """Close the underlying HTTP client."""
+        await self._client.aclose()
     
-    def _call_api(self, prompt: str) -> str:
-        """Call the AIPipe API."""
-        payload = {
-            "model": "openai/gpt-4o-mini",
+    async def generate_code(
+        self, 
+        brief: str, 
+        checks: List[str], 
+        attachment_names: List[str],
+        existing_code: Optional[Dict[str, str]] = None,
+        use_cache: bool = True
+    ) -> Dict[str, str]:
+        """
+        Generate code using LLM.
+        
+        Args:
+            brief: Project brief/description
+            checks: List of evaluation criteria
+            attachment_names: List of attachment filenames
+            existing_code: Existing files to modify, by filename (for round > 1)
+            use_cache: Reuse the response from an earlier call with identical inputs
+        
+        Returns:
+            Dictionary mapping filename to file content
+        """
+        # Build prompt
+        prompt = self._build_prompt(brief, checks, attachment_names, existing_code)
+        
+        # Identical (model, prompt) pairs reuse the earlier response
+        cache_key = hashlib.sha256(json.dumps([MODEL, SYSTEM_PROMPT, prompt]).encode()).hexdigest()
+        if use_cache:
+            cached = llm_cache_get(cache_key)
+            if cached is not None:
+                print(f"LLM cache hit: {cache_key[:12]}")
+                return self._parse_response(cached)
+        
+        # Near-duplicate briefs reuse an earlier result. Only first rounds are
+        # matched, since a modification also depends on the existing code
+        semantic_text = None
+        if use_cache and self.semantic_cache and not existing_code:
+            semantic_text = "\n".join([brief, *checks])
+            try:
+                files = await asyncio.to_thread(self.semantic_cache.get, semantic_text, attachment_names)
+                if files is not None:
+                    return files
+            except Exception as e:
+                # The cache is only an optimization; fall through to the LLM
+                print(f"Semantic cache lookup failed: {e}")
+        
+        # Call LLM API
+        response = await self._call_api(prompt)
+        
+        # Parse response to extract files
+        files = self._parse_response(response)
+        
+        # Only cache responses that parsed, so a bad one is retried next time
+        if use_cache:
+            llm_cache_put(cache_key, response)
+        if semantic_text is not None:
+            try:
+                await asyncio.to_thread(self.semantic_cache.put, semantic_text, attachment_names, files)
+            except Exception as e:
+                # Don't fail a good response because it couldn't be cached
+                print(f"Semantic cache store failed: {e}")
+        
+        return files
+    
+    async def generate_code_batch(
+        self,
+        jobs: List[Dict],
+        max_concurrency: int = 10
+    ) -> List[Optional[Dict[str, str]]]:
+        """
+        Generate code for several tasks concurrently.
+        
+        Args:
+            jobs: Keyword arguments for generate_code, one dict per task
+            max_concurrency: Most LLM calls allowed in flight at once
+        
+        Returns:
+            Generated files for each job, in the same order as jobs (None for
+            jobs that failed, which are logged, as in poll_batch)
+        """
+        # Bound the fan-out so a large batch doesn't trip provider rate limits
+        semaphore = asyncio.Semaphore(max_concurrency)
+        
+        async def run(index: int, job: Dict) -> Optional[Dict[str, str]]:
+            async with semaphore:
+                try:
+                    return await self.generate_code(**job)
+                except Exception as e:
+                    # One failed job shouldn't discard the others' results
+                    print(f"Batch job {index} failed: {e}")
+                    return None
+        
+        return await asyncio.gather(*(run(index, job) for index, job in enumerate(jobs)))
+    
+    async def submit_batch(self, jobs: List[Dict]) -> str:
+        """
+        Submit jobs to the provider's Batch API instead of calling the model directly.
+        
+        Batches cost less and don't count against the live rate limit, but
+        can take up to 24 hours, so use this only when latency doesn't matter.
+        Requires a provider that implements the OpenAI /files and /batches
+        endpoints.
+        
+        Args:
+            jobs: Keyword arguments for generate_code, one dict per task
+                (use_cache is ignored; batch results are never cached)
+        
+        Returns:
+            Batch ID to pass to poll_batch
+        """
+        lines = [
+            json.dumps({
+                "custom_id": str(index),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": self._chat_payload(self._build_prompt(
+                    job["brief"],
+                    job["checks"],
+                    job["attachment_names"],
+                    job.get("existing_code")
+                ))
+            })
+            for index, job in enumerate(jobs)
+        ]
+        
+        upload = await self._client.post(
+            "/files",
+            data={"purpose": "batch"},
+            files={"file": ("batch.jsonl", "\n".join(lines).encode(), "application/jsonl")}
+        )
+        upload.raise_for_status()
+        
+        response = await self._client.post("/batches", json={
+            "input_file_id": orjson.loads(upload.content)["id"],
+            "endpoint": "/v1/chat/completions",
+            "completion_window": "24h"
+        })
+        response.raise_for_status()
+        batch = orjson.loads(response.content)
+        
+        update_task_info(batch["id"], {
+            "batch_id": batch["id"],
+            "status": batch["status"],
+            "jobs": len(jobs)
+        })
+        print(f"Submitted batch {batch['id']} with {len(jobs)} jobs")
+        return batch["id"]
+    
+    async def poll_batch(self, batch_id: str) -> Optional[List[Optional[Dict[str, str]]]]:
+        """
+        Check a batch submitted with submit_batch and collect its results.
+        
+        Args:
+            batch_id: Batch ID returned by submit_batch
+        
+        Returns:
+            Generated files per job in submission order (None for jobs that
+            failed), or None if the batch is still running
+        """
+        response = await self._client.get(f"/batches/{batch_id}")
+        response.raise_for_status()
+        batch = orjson.loads(response.content)
+        
+        # Fall back to the job count recorded by submit_batch if the provider omits it
+        jobs = (batch.get("request_counts") or {}).get("total") or (get_task_info(batch_id) or {}).get("jobs", 0)
+        update_task_info(batch_id, {"batch_id": batch_id, "status": batch["status"], "jobs": jobs})
+        
+        if batch["status"] in ("failed", "expired", "cancelled"):
+            raise ValueError(f"Batch {batch_id} ended with status {batch['status']}")
+        if batch["status"] != "completed":
+            return None
+        
+        # Requests that failed outright are listed in the error file
+        if batch.get("error_file_id"):
+            for result in await self._batch_file_lines(batch["error_file_id"]):
+                error = result.get("error") or ((result.get("response") or {}).get("body") or {}).get("error")
+                print(f"Batch {batch_id} job {result.get('custom_id')} failed: {error}")
+        
+        # A batch where every request failed completes with no output file
+        results: Dict[int, Optional[Dict[str, str]]] = {}
+        output_lines = await self._batch_file_lines(batch["output_file_id"]) if batch.get("output_file_id") else []
+        for result in output_lines:
+            index = int(result["custom_id"])
+            body = (result.get("response") or {}).get("body") or {}
+            try:
+                results[index] = self._parse_response(body["choices"][0]["message"]["content"])
+            except (KeyError, IndexError, ValueError) as e:
+                results[index] = None
+                print(f"Batch {batch_id} job {index} failed: {e}")
+        
+        # Size by the output too, in case neither source knew the job count
+        total = max(jobs, max(results, default=-1) + 1)
+        return [results.get(index) for index in range(total)]
+    
+    async def _batch_file_lines(self, file_id: str) -> List[Dict]:
+        """Download a Batch API result file and decode its JSONL lines."""
+        response = await self._client.get(f"/files/{file_id}/content")
+        response.raise_for_status()
+        return [orjson.loads(line) for line in response.content.splitlines() if line.strip()]
+    
+    def _build_prompt(
+        self,
+        brief: str,
+        checks: List[str],
+        attachment_names: List[str],
+        existing_code: Optional[Dict[str, str]] = None
+    ) -> str:
+        """Build the initial or modification prompt for these inputs."""
+        if existing_code:
+            return self._build_modification_prompt(brief, checks, attachment_names, existing_code)
+        return self._build_initial_prompt(brief, checks, attachment_names)
+    
+    def _build_initial_prompt(self, brief: str, checks: List[str], attachment_names: List[str]) -> str:
+        """Build prompt for initial code generation."""
+        # Static instructions first so providers can reuse the cached prefix
+        parts = [INITIAL_PROMPT_HEADER]
+        if attachment_names:
+            parts += [INITIAL_ATTACHMENTS_BLOCK, "\n".join("- " + name for name in attachment_names), "\n"]
+        
+        parts += [
+            INITIAL_BRIEF_LABEL, brief,
+            CHECKS_LABEL, "\n".join("- " + check for check in checks),
+            FOOTER_BLOCK
+        ]
+        return "".join(parts)
+    
+    def _build_modification_prompt(
+        self, 
+        brief: str, 
+        checks: List[str], 
+        attachment_names: List[str],
+        existing_code: Dict[str, str]
+    ) -> str:
+        """Build prompt for code modification."""
+        # Static instructions first so providers can reuse the cached prefix
+        parts = [MODIFICATION_PROMPT_HEADER]
+        if attachment_names:
+            parts += [MODIFICATION_ATTACHMENTS_BLOCK, "\n".join("- " + name for name in attachment_names), "\n"]
+        
+        parts += [
+            MODIFICATION_BRIEF_LABEL, brief,
+            CHECKS_LABEL, "\n".join("- " + check for check in checks),
+            EXISTING_FILES_LABEL, self._file_manifest(existing_code)
+        ]
+        
+        # Send full content only for the files this round is likely to touch
+        mentioned = self._mentioned_files(existing_code, brief, checks)
+        if mentioned:
+            parts += [
+                EXISTING_CODE_LABEL,
+                "\n\n".join(f"=== {filename} ===\n{existing_code[filename]}" for filename in mentioned)
+            ]
+        
+        parts.append(FOOTER_BLOCK)
+        return "".join(parts)
+    
+    @staticmethod
+    def _file_manifest(files: Dict[str, str]) -> str:
+        """List each file with a short content hash and its size."""
+        lines = []
+        for filename, content in files.items():
+            data = content.encode()
+            digest = hashlib.sha256(data).hexdigest()[:12]
+            lines.append(f"- {filename} (sha256 {digest}, {len(data) / 1024:.1f}KB)")
+        return "\n".join(lines)
+    
+    @staticmethod
+    def _mentioned_files(files: Dict[str, str], brief: str, checks: List[str]) -> List[str]:
+        """Return the files to send in full: always included, named in the brief or checks, or loaded by those."""
+        text = "\n".join([brief, *checks]).lower()
+        selected = {
+            filename for filename in files
+            if filename not in CONTEXT_EXCLUDED_FILES
+            and (filename in ALWAYS_INCLUDED_FILES or LLMService._names_file(text, filename))
+        }
+        
+        # Follow src/href references, so the scripts and styles index.html
+        # loads are shown to the model instead of being rewritten blind
+        pending = list(selected)
+        while pending:
+            filename = pending.pop()
+            directory = posixpath.dirname(filename)
+            for ref in REFERENCE_RE.findall(files[filename]):
+                if ":" in ref or ref.startswith("/"):
+                    # Absolute or external URL
+                    continue
+                target = posixpath.normpath(posixpath.join(directory, ref))
+                if target in files and target not in selected and target not in CONTEXT_EXCLUDED_FILES:
+                    selected.add(target)
+                    pending.append(target)
+        
+        return [filename for filename in files if filename in selected]
+    
+    @staticmethod
+    def _names_file(text: str, filename: str) -> bool:
+        """Whether text names the file by its path or basename, as a whole word."""
+        for name in {filename.lower(), posixpath.basename(filename).lower()}:
+            # Not part of a longer name on either side; a trailing full stop is fine
+            if re.search(r'(?<![\w./-])' + re.escape(name) + r'(?![\w/-]|\.\w)', text):
+                return True
+        return False
+    
+    def _chat_payload(self, prompt: str, max_tokens: int = MAX_TOKENS) -> Dict:
+        """Build the chat completion request body for a prompt."""
+        return {
+            "model": MODEL,
             "messages": [
                 {
                     "role": "system",
-                    "content": "You are a code generator that ONLY outputs valid JSON. Never include explanations or markdown. Follow instructions precisely. Always complete your JSON response fully."
+                    "content": SYSTEM_PROMPT
                 },
                 {
                     "role": "user",
@@ -215,87 +525,135 @@ Only include files you're modifying. Return ONLY the JSON, nothing else."""
                 }
             ],
             "temperature": 0.3,
-            "max_tokens": 4000
+            "max_tokens": max_tokens
         }
-        
-        with httpx.Client(timeout=180.0) as client:
-            response = client.post(
-                f"{self.base_url}/chat/completions",
-                headers=self.headers,
-                json=payload
-            )
-            response.raise_for_status()
-            
-            data = response.json()
-            content = data["choices"][0]["message"]["content"]
+    
+    async def _call_api(self, prompt: str) -> str:
+        """Call the AIPipe API, retrying transient failures and truncated responses."""
+        max_tokens = MAX_TOKENS
+        attempt = 0
+        while True:
+            payload = {**self._chat_payload(prompt, max_tokens), "stream": True}
+            try:
+                content, finish_reason = await self._stream_completion(payload)
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code not in RETRY_STATUSES or attempt >= MAX_RETRIES:
+                    raise
+                delay = self._retry_delay(e.response, attempt)
+                attempt += 1
+                print(f"LLM API returned {e.response.status_code}, retrying in {delay:.1f}s ({attempt}/{MAX_RETRIES})")
+                await asyncio.sleep(delay)
+                continue
+            except httpx.TransportError as e:
+                # Timeouts, refused connections and streams cut off mid-response
+                if attempt >= MAX_RETRIES:
+                    raise
+                delay = self._retry_delay(None, attempt)
+                attempt += 1
+                print(f"LLM API request failed ({e!r}), retrying in {delay:.1f}s ({attempt}/{MAX_RETRIES})")
+                await asyncio.sleep(delay)
+                continue
             
-            # Check if response was truncated
-            finish_reason = data["choices"][0].get("finish_reason")
+            # Check if response was truncated, and give it one more go with room to finish
             if finish_reason == "length":
+                if max_tokens == MAX_TOKENS:
+                    max_tokens *= 2
+                    print(f"LLM response hit max_tokens, retrying with max_tokens={max_tokens}")
+                    continue
                 raise ValueError("LLM response was truncated due to max_tokens limit. Response may be incomplete.")
             
             return content
     
+    @staticmethod
+    def _retry_delay(response: Optional[httpx.Response], attempt: int) -> float:
+        """Seconds to wait before retrying, preferring the server's Retry-After."""
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after:
+            try:
+                return min(RETRY_MAX_DELAY, max(0.0, float(retry_after)))
+            except ValueError:
+                # HTTP-date form; fall back to our own backoff
+                pass
+        return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt) + random.random() * RETRY_BASE_DELAY
+    
+    async def _stream_completion(self, payload: Dict) -> Tuple[str, Optional[str]]:
+        """Stream a chat completion and return its content and finish_reason."""
+        # Stream server-sent events and collect the content deltas as they arrive
+        parts = []
+        finish_reason = None
+        async with self._client.stream("POST", "/chat/completions", json=payload) as response:
+            response.raise_for_status()
+            
+            # aiter_lines buffers partial chunks until a full line is available
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                
+                choices = orjson.loads(data).get("choices")
+                if not choices:
+                    # e.g. a trailing usage-only frame
+                    continue
+                choice = choices[0]
+                parts.append(choice.get("delta", {}).get("content") or "")
+                finish_reason = choice.get("finish_reason") or finish_reason
+        
+        return "".join(parts), finish_reason
+    
     def _parse_response(self, response: str) -> Dict[str, str]:
         """Parse LLM response to extract files with robust error handling."""
-        import re
-        
-        # Clean the response
-        response = response.strip()
+        # Clean the response, finding the bounds of the content first so the
+        # (possibly large) string is sliced only once
+        response = response.lstrip()
+        start, end = 0, len(response)
+        while end and response[end - 1].isspace():
+            end -= 1
         
         # Remove markdown code blocks
         if response.startswith("```json"):
-            response = response[7:]
+            start = 7
         elif response.startswith("```"):
-            response = response[3:]
-        if response.endswith("```"):
-            response = response[:-3]
+            start = 3
+        if end - start >= 3 and response.endswith("```", start, end):
+            end -= 3
         
-        response = response.strip()
+        while start < end and response[start].isspace():
+            start += 1
+        while end > start and response[end - 1].isspace():
+            end -= 1
+        if (start, end) != (0, len(response)):
+            response = response[start:end]
         
         # Try direct JSON parsing first
         try:
-            files = json.loads(response)
+            files = orjson.loads(response)
             if isinstance(files, dict):
                 return files
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             pass
         
-        # Try to extract JSON object using regex
-        json_matches = re.finditer(r'\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\}', response, re.DOTALL)
-        for match in json_matches:
-            try:
-                files = json.loads(match.group())
-                if isinstance(files, dict) and any(key.endswith('.html') for key in files.keys()):
-                    return files
-            except:
-                continue
-        
-        # Try to find the largest JSON-like structure and fix common issues
-        try:
-            start = response.find('{')
-            end = response.rfind('}')
-            if start != -1 and end != -1 and end > start:
-                json_str = response[start:end+1]
-                
-                # Fix common JSON issues
-                # Remove trailing commas before closing braces
-                json_str = re.sub(r',(\s*[}\]])', r'\1', json_str)
-                
-                files = json.loads(json_str)
-                if isinstance(files, dict):
-                    return files
-        except:
-            pass
+        # Decode the first JSON object in one linear pass, ignoring any text
+        # around it; if that fails, retry once with trailing commas removed
+        start = response.find('{')
+        if start != -1:
+            decoder = json.JSONDecoder()
+            json_str = response[start:]
+            for candidate in (json_str, TRAILING_COMMA_RE.sub(r'\1', json_str)):
+                try:
+                    files, _ = decoder.raw_decode(candidate)
+                    if isinstance(files, dict):
+                        return files
+                except json.JSONDecodeError:
+                    continue
         
         # Last resort: try to manually extract key-value pairs
         try:
             files = {}
-            # Look for patterns like "filename.ext": "content"
-            pattern = r'"([^"]+\.(html|css|js|md))"\s*:\s*"((?:[^"\\]|\\.)*)"'
-            matches = re.findall(pattern, response, re.DOTALL)
+            matches = FILE_ENTRY_RE.findall(response)
             for filename, ext, content in matches:
-                files[filename] = content.replace('\\n', '\n').replace('\\t', '\t').replace('\\"', '"')
+                files[filename] = self._unescape_json_string(content)
             
             if files:
                 return files
@@ -304,4 +662,15 @@ Only include files you're modifying. Return ONLY the JSON, nothing else."""
         
         # If all else fails, create a basic structure
         raise ValueError(f"Failed to parse LLM response as valid JSON. Response preview: {response[:500]}")
+    
+    @staticmethod
+    def _unescape_json_string(content: str) -> str:
+        """Decode the escapes in the body of a JSON string literal."""
+        # Decoding it as a JSON string handles every escape (\uXXXX, \/ ...)
+        # and leaves non-ASCII text intact, unlike unicode_escape
+        try:
+            return orjson.loads(f'"{content}"')
+        except orjson.JSONDecodeError:
+            # e.g. a raw control character inside the string; keep the basics
+            return content.replace('\\n', '\n').replace('\\t', '\t').replace('\\"', '"')
 
@@ -0,0 +1,115 @@
+"""Semantic cache that reuses generated files for near-duplicate briefs."""
+import os
+import threading
+from typing import Dict, List, Optional
+import orjson
+
+# Optional dependencies: without them the semantic cache is simply disabled
+try:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    np = None
+    SentenceTransformer = None
+
+
+SEMANTIC_CACHE_AVAILABLE = SentenceTransformer is not None
+
+SEMANTIC_CACHE_DIR = os.path.join(".cache", "semantic")
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+
+# Cosine similarity above which two briefs count as the same task
+SIMILARITY_THRESHOLD = 0.92
+
+
+class SemanticCache:
+    """Embedding-indexed store of generated files, persisted under SEMANTIC_CACHE_DIR."""
+    
+    def __init__(
+        self,
+        cache_dir: str = SEMANTIC_CACHE_DIR,
+        model_name: str = EMBEDDING_MODEL,
+        threshold: float = SIMILARITY_THRESHOLD
+    ):
+        """
+        Initialize the semantic cache.
+        
+        Args:
+            cache_dir: Directory holding the embeddings matrix and entries
+            model_name: sentence-transformers model used to embed briefs
+            threshold: Minimum cosine similarity for a cache hit
+        """
+        self.cache_dir = cache_dir
+        self.model_name = model_name
+        self.threshold = threshold
+        self._model = None
+        # Row i of the matrix is the unit-length embedding of entries[i]
+        self._matrix = None
+        self._entries: List[Dict] = []
+        self._loaded = False
+        # get/put run in worker threads, possibly several at once
+        self._lock = threading.Lock()
+    
+    def get(self, text: str, attachment_names: List[str]) -> Optional[Dict[str, str]]:
+        """Return the files stored for the most similar text, or None on a miss."""
+        query = self._embed(text)
+        with self._lock:
+            self._load()
+            if not self._entries:
+                return None
+            # Rows and query are unit length, so the dot product is the cosine similarity
+            scores = self._matrix @ query
+            attachments = sorted(attachment_names)
+            for index in np.argsort(scores)[::-1]:
+                if scores[index] < self.threshold:
+                    break
+                # Generated code refers to attachments by name, so those must match too
+                if self._entries[index]["attachments"] == attachments:
+                    print(f"Semantic cache hit: similarity {scores[index]:.3f}")
+                    return self._entries[index]["files"]
+        return None
+    
+    def put(self, text: str, attachment_names: List[str], files: Dict[str, str]):
+        """Store generated files under the embedding of text."""
+        vector = self._embed(text)
+        with self._lock:
+            self._load()
+            row = vector[np.newaxis, :]
+            self._matrix = row if self._matrix is None else np.vstack([self._matrix, row])
+            self._entries.append({"attachments": sorted(attachment_names), "files": files})
+            self._save()
+    
+    def _embed(self, text: str):
+        """Return the unit-length embedding of text, loading the model on first use."""
+        if self._model is None:
+            self._model = SentenceTransformer(self.model_name)
+        return self._model.encode(text, normalize_embeddings=True).astype(np.float32)
+    
+    def _load(self):
+        """Read the persisted matrix and entries once per process."""
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            self._matrix = np.load(os.path.join(self.cache_dir, "embeddings.npy"))
+            with open(os.path.join(self.cache_dir, "entries.json"), 'rb') as f:
+                self._entries = orjson.loads(f.read())
+        except (OSError, ValueError):
+            self._matrix, self._entries = None, []
+            return
+        
+        # A partial write from an older process leaves the two files out of step
+        if len(self._matrix) != len(self._entries):
+            self._matrix, self._entries = None, []
+    
+    def _save(self):
+        """Persist the matrix and entries, swapping each file in atomically."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        matrix_path = os.path.join(self.cache_dir, "embeddings.npy")
+        entries_path = os.path.join(self.cache_dir, "entries.json")
+        with open(f"{matrix_path}.tmp", 'wb') as f:
+            np.save(f, self._matrix)
+        with open(f"{entries_path}.tmp", 'wb') as f:
+            f.write(orjson.dumps(self._entries))
+        os.replace(f"{matrix_path}.tmp", matrix_path)
+        os.replace(f"{entries_path}.tmp", entries_path)
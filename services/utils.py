@@ -1,63 +1,32 @@
 """Utility functions for the application."""
-import base64
+import binascii
 import json
 import os
-from typing import Dict, Optional
+import sqlite3
+import tempfile
+import time
+from typing import Dict, Optional, Tuple, Union
+import orjson
 
 
-STATE_FILE = "state.json"
+STATE_DB = "state.db"
+# Flat JSON store used before state.db; imported once when the database is created
+LEGACY_STATE_FILE = "state.json"
+LLM_CACHE_DIR = os.path.join(".cache", "llm")
 
+# Base64 characters read per write by decode_data_uri_to_file
+DECODE_CHUNK_SIZE = 64 * 1024
 
-def decode_data_uri(data_uri: str) -> bytes:
-    """
-    Decode a data URI to bytes.
-    
-    Args:
-        data_uri: Data URI string (e.g., "data:image/png;base64,iVBORw...")
-    
-    Returns:
-        Decoded bytes
-    """
-    # Extract the base64 part after the comma
-    if ',' in data_uri:
-        base64_data = data_uri.split(',', 1)[1]
-    else:
-        base64_data = data_uri
-    
-    return base64.b64decode(base64_data)
-
-
-def load_state() -> Dict:
-    """Load state from JSON file."""
-    if not os.path.exists(STATE_FILE):
-        return {}
-    
-    with open(STATE_FILE, 'r') as f:
-        return json.load(f)
-
+# How long get_task_info reuses a lookup before querying the database again
+TASK_INFO_TTL = 30  # seconds
+# Most task lookups kept by get_task_info
+TASK_INFO_CACHE_SIZE = 1024
 
-def save_state(state: Dict):
-    """Save state to JSON file."""
-    with open(STATE_FILE, 'w') as f:
-        json.dump(state, f, indent=2)
+_task_info_cache: Dict[str, Tuple[float, Dict]] = {}
 
+_state_db: Optional[sqlite3.Connection] = None
 
-def get_task_info(task_id: str) -> Optional[Dict]:
-    """Get task information from state."""
-    state = load_state()
-    return state.get(task_id)
-
-
-def update_task_info(task_id: str, info: Dict):
-    """Update task information in state."""
-    state = load_state()
-    state[task_id] = info
-    save_state(state)
-
-
-def get_mit_license() -> str:
-    """Return MIT License text."""
-    return """MIT License
+MIT_LICENSE = """MIT License
 
 Copyright (c) 2025
 
@@ -80,3 +49,151 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+
+def decode_data_uri(data_uri: Union[str, bytes]) -> bytes:
+    """
+    Decode a data URI to bytes.
+    
+    Args:
+        data_uri: Data URI string (e.g., "data:image/png;base64,iVBORw...")
+    
+    Returns:
+        Decoded bytes
+    """
+    # Decode only the base64 part after the comma, without splitting the
+    # whole string; a2b_base64 is the C routine underneath b64decode
+    if isinstance(data_uri, bytes):
+        # Slice through a memoryview so large byte payloads aren't copied
+        comma = data_uri.find(b',')
+        payload = memoryview(data_uri)[comma + 1:]
+    else:
+        comma = data_uri.find(',')
+        payload = data_uri[comma + 1:] if comma != -1 else data_uri
+    return binascii.a2b_base64(payload)
+
+
+def decode_data_uri_to_file(data_uri: Union[str, bytes], path: str) -> int:
+    """
+    Decode a data URI straight into a file, a chunk at a time.
+    
+    Args:
+        data_uri: Data URI string (e.g., "data:image/png;base64,iVBORw...")
+        path: File to write the decoded bytes to
+    
+    Returns:
+        Number of bytes written
+    """
+    is_text = isinstance(data_uri, str)
+    comma = data_uri.find(',' if is_text else b',')
+    empty = '' if is_text else b''
+    
+    # Only one decoded chunk is held at a time instead of the whole payload.
+    # Whitespace (e.g. line-wrapped base64) is dropped, and characters past
+    # the last full 4-character group carry over to the next chunk
+    written = 0
+    leftover = empty
+    with open(path, 'wb') as f:
+        for i in range(comma + 1, len(data_uri), DECODE_CHUNK_SIZE):
+            chunk = leftover + empty.join(data_uri[i:i + DECODE_CHUNK_SIZE].split())
+            usable = len(chunk) - len(chunk) % 4
+            written += f.write(binascii.a2b_base64(chunk[:usable]))
+            leftover = chunk[usable:]
+        if leftover:
+            # Unpadded tail; a2b_base64 raises just as decode_data_uri would
+            written += f.write(binascii.a2b_base64(leftover))
+    return written
+
+
+def get_state_db() -> sqlite3.Connection:
+    """Return the state database connection, creating the tasks table on first use."""
+    global _state_db
+    if _state_db is None:
+        # Autocommit mode: every statement is its own transaction
+        db = sqlite3.connect(STATE_DB, isolation_level=None, check_same_thread=False)
+        # WAL lets readers proceed while a write is in progress
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("CREATE TABLE IF NOT EXISTS tasks (id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        
+        # Carry over tasks recorded in the old JSON store
+        if os.path.exists(LEGACY_STATE_FILE) and db.execute("SELECT 1 FROM tasks LIMIT 1").fetchone() is None:
+            with open(LEGACY_STATE_FILE, 'rb') as f:
+                legacy = orjson.loads(f.read())
+            db.executemany(
+                "INSERT OR REPLACE INTO tasks (id, data) VALUES (?, ?)",
+                [(task_id, orjson.dumps(info).decode()) for task_id, info in legacy.items()]
+            )
+            print(f"Imported {len(legacy)} tasks from {LEGACY_STATE_FILE}")
+        _state_db = db
+    return _state_db
+
+
+def get_task_info(task_id: str) -> Optional[Dict]:
+    """Get task information from state; found tasks are cached for TASK_INFO_TTL seconds."""
+    entry = _task_info_cache.get(task_id)
+    if entry and time.monotonic() - entry[0] < TASK_INFO_TTL:
+        return entry[1]
+    
+    row = get_state_db().execute("SELECT data FROM tasks WHERE id = ?", (task_id,)).fetchone()
+    if row is None:
+        # Not cached: another worker may record this task at any moment
+        return None
+    
+    info = orjson.loads(row[0])
+    _task_info_cache.pop(task_id, None)
+    if len(_task_info_cache) >= TASK_INFO_CACHE_SIZE:
+        # Evict the oldest entry
+        _task_info_cache.pop(next(iter(_task_info_cache)))
+    _task_info_cache[task_id] = (time.monotonic(), info)
+    return info
+
+
+def update_task_info(task_id: str, info: Dict):
+    """Update task information in state."""
+    # Only this task's row is written, however many tasks are stored
+    get_state_db().execute(
+        "INSERT OR REPLACE INTO tasks (id, data) VALUES (?, ?)",
+        (task_id, orjson.dumps(info).decode())
+    )
+    _task_info_cache.pop(task_id, None)
+
+
+def _llm_cache_path(key: str) -> str:
+    """Return the cache file path for a key, sharded by its first two characters."""
+    return os.path.join(LLM_CACHE_DIR, key[:2], f"{key}.json")
+
+
+def llm_cache_get(key: str) -> Optional[str]:
+    """Return a cached LLM response, or None on a miss."""
+    try:
+        with open(_llm_cache_path(key), 'r') as f:
+            return json.load(f)["response"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def llm_cache_put(key: str, response: str):
+    """Store an LLM response in the disk cache, logging rather than raising on failure."""
+    path = _llm_cache_path(key)
+    tmp_path = None
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a uniquely named temporary file first, so readers never see
+        # a partial entry and concurrent writers don't clobber each other
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, 'w') as f:
+            json.dump({"response": response}, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Failed to write LLM cache entry {key[:12]}: {e}")
+        if tmp_path:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+def get_mit_license() -> str:
+    """Return MIT License text."""
+    return MIT_LICENSE
+